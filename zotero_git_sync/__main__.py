@@ -1,39 +1,59 @@
+from asyncio import (
+    Future, Semaphore, Task, as_completed, create_task, gather, run, sleep,
+    to_thread,
+)
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from os import scandir
 from pathlib import Path
-from re import sub
+from re import compile as re_compile
 from tempfile import TemporaryDirectory
-from typing import Optional
-
-from git import Repo
-from ratelimit import rate_limited, sleep_and_retry
-from requests import Session
-from requests.adapters import HTTPAdapter
+from time import monotonic
+from typing import AsyncIterator, Optional
+
+from aiofiles import open as async_open
+from aiohttp import (
+    ClientConnectionError, ClientPayloadError, ClientResponse,
+    ClientResponseError, ClientSession, ClientTimeout, TCPConnector,
+)
+from git import GitCommandError, Repo
+from orjson import loads
 from tqdm.auto import tqdm
 from unidecode import unidecode
-from urllib3 import Retry
 from yaml import safe_load
 
 _CONFIG_FILE = Path(__file__).parent.parent / "config.yaml"
 
+_NAME_TRANSLATION = str.maketrans({
+    char: "-"
+    for char in "\n\"'.:;,!?()[]+&_ /"
+})
+_NAME_DASHES = re_compile(r"-+")
+_YEAR = re_compile(r"\d{4}")
+
 
 def _read_lock(lock_path: Path, export_path: Path) -> dict[str, Path]:
     lock_path.touch()
     with lock_path.open("rt") as file:
         lock_lines = (
-            line.strip().split()
-            for line in file.readlines()
+            line.rstrip().partition(" ")
+            for line in file
         )
         return {
-            item_id.strip(): export_path / file_name.strip()
-            for item_id, file_name in lock_lines
+            item_id: export_path / file_name
+            for item_id, _, file_name in lock_lines
+            if item_id
         }
 
 
 def _write_lock(lock_path: Path, lock: dict[str, Path]) -> None:
     lock_items = sorted(lock.items(), key=lambda item: item[0])
-    with lock_path.open("wt") as file:
-        for item_id, path in lock_items:
-            file_name = path.name
-            file.write(f"{item_id} {file_name}\n")
+    lock_path.write_text("".join(
+        f"{item_id} {path.name}\n"
+        for item_id, path in lock_items
+    ))
 
 
 def _item_id(item: dict) -> str:
@@ -41,102 +61,339 @@ def _item_id(item: dict) -> str:
 
 
 def _item_has_pdf_attachment(item: dict) -> bool:
-    if "attachment" not in item["links"]:
+    attachment = item["links"].get("attachment")
+    if attachment is None:
         return False
-    return item["links"]["attachment"]["attachmentType"] == "application/pdf"
+    return attachment["attachmentType"] == "application/pdf"
+
+
+def _item_year(item: dict) -> str:
+    year_match = _YEAR.search(item["meta"].get("parsedDate", ""))
+    return year_match.group()[-2:] if year_match is not None else ""
+
 
+def _pdf_items(items: list[dict]) -> dict[str, dict]:
+    pdf_items = {}
+    for item in items:
+        if _item_has_pdf_attachment(item):
+            # Parse the year once, while the item is at hand.
+            item["_year"] = _item_year(item)
+            pdf_items[_item_id(item)] = item
+    return pdf_items
 
+
+@lru_cache(maxsize=4096)
 def _normalize_name(name: str) -> str:
-    name = unidecode(name)
+    if not name.isascii():
+        name = unidecode(name)
     name = name.lower()
-    name = name.replace("\n", "-")
-    name = name.replace("\"", "-")
-    name = name.replace("'", "-")
-    name = name.replace(".", "-")
-    name = name.replace(":", "-")
-    name = name.replace(";", "-")
-    name = name.replace(",", "-")
-    name = name.replace("!", "-")
-    name = name.replace("?", "-")
-    name = name.replace("(", "-")
-    name = name.replace(")", "-")
-    name = name.replace("[", "-")
-    name = name.replace("]", "-")
-    name = name.replace("+", "-")
-    name = name.replace("&", "-")
-    name = name.replace("_", "-")
-    name = name.replace(" ", "-")
-    name = name.replace("/", "-")
-    name = sub(r"-+", "-", name)
+    name = name.translate(_NAME_TRANSLATION)
+    name = _NAME_DASHES.sub("-", name)
     name = name.removeprefix("-")
     name = name.removesuffix("-")
     return name
 
 
 def _item_path(item: dict, export_path: Path) -> Path:
-    first_author_last_names = [
-        creator["lastName"] if "lastName" in creator else creator["name"]
-        for creator in item["data"]["creators"]
-        if creator["creatorType"] == "author"
-    ]
-    first_author_last_names.append("noauthor")
-    first_author_last_name = _normalize_name(first_author_last_names[0])
-    date: str
-    if "parsedDate" in item["meta"]:
-        date = item["meta"]["parsedDate"]
-    else:
-        date = ""
-    year: str
-    if "/" in date:
-        year = date.split("/")[-1]
-    elif "-" in date:
-        year = date.split("-")[0]
-    else:
-        year = date
-    if len(year) > 2:
-        year = year[-2:]
-    title = _normalize_name(item["data"]["title"])
-    file_name = f"{first_author_last_name}{year}-{title}.pdf"
+    data = item["data"]
+    first_author_last_name = next(
+        (
+            creator["lastName"] if "lastName" in creator else creator["name"]
+            for creator in data["creators"]
+            if creator["creatorType"] == "author"
+        ),
+        "noauthor",
+    )
+    first_author_last_name = _normalize_name(first_author_last_name)
+    title = _normalize_name(data["title"])
+    file_name = f"{first_author_last_name}{item['_year']}-{title}.pdf"
     return export_path / file_name
 
 
-def _move_to_subdir(path: Path, subdir_path: Path) -> None:
+def _track_increment(increments: dict[str, int], name: str) -> None:
+    path = Path(name)
+    stem, _, increment = path.stem.rpartition(".")
+    if stem and increment.isdigit():
+        name = f"{stem}{path.suffix}"
+        increments[name] = max(increments.get(name, 0), int(increment))
+
+
+def _subdir_increments(subdir_path: Path) -> dict[str, int]:
+    increments: dict[str, int] = {}
+    with scandir(subdir_path) as entries:
+        for entry in entries:
+            _track_increment(increments, entry.name)
+    return increments
+
+
+def _move_to_subdir(
+        path: Path,
+        subdir_path: Path,
+        increments: dict[str, int],
+) -> None:
     new_path = subdir_path / path.name
-    if new_path.exists():
-        increment = 1
-        while new_path.exists():
-            new_path = subdir_path / f"{path.stem}.{increment}{path.suffix}"
-            increment += 1
+    while new_path.exists():
+        # Never overwrite files, even if the increments are outdated.
+        increment = increments.get(path.name, 0) + 1
+        increments[path.name] = increment
+        new_path = subdir_path / f"{path.stem}.{increment}{path.suffix}"
+    _track_increment(increments, new_path.name)
     path.rename(new_path)
 
 
-@sleep_and_retry
-@rate_limited(calls=5, period=15)
-def _download_pdf(
-        session: Session,
+def _move_files(
+        paths: set[Path],
+        move_paths: dict[Path, Path],
+        subdir_path: Path,
+) -> None:
+    increments = _subdir_increments(subdir_path)
+    for path in paths:
+        if path in move_paths:
+            # Still in use, rename.
+            path.rename(move_paths[path])
+        else:
+            # No corresponding item, move to subdir.
+            _move_to_subdir(path, subdir_path, increments)
+
+
+def _clone_repo(
+        git_repository_url: str,
+        repo_path: Path,
+        export_path: str,
+) -> Repo:
+    # Fetch file contents lazily and only check out the export path.
+    repo = Repo.clone_from(
+        git_repository_url,
+        repo_path,
+        depth=1,
+        multi_options=["--filter=blob:none", "--no-checkout"],
+    )
+    if Path(export_path) != Path("."):
+        # In cone mode, the repository root would only include root files.
+        repo.git.sparse_checkout("init", "--cone")
+        repo.git.sparse_checkout("set", export_path)
+    repo.git.checkout()
+    return repo
+
+
+def _uses_lfs(repo: Repo, export_path: Path) -> bool:
+    # Placeholder path, only used to look up the attributes of PDFs.
+    pdf_path = export_path / "placeholder.pdf"
+    attributes = repo.git.check_attr("filter", "--", pdf_path)
+    if not attributes.endswith(": lfs"):
+        return False
+    try:
+        repo.git.lfs("env")
+    except GitCommandError:
+        # Git LFS is not installed.
+        return False
+    return True
+
+
+def _client_session() -> ClientSession:
+    # Keep connections alive between requests, e.g., during backoff.
+    connector = TCPConnector(limit=20, limit_per_host=5, keepalive_timeout=60)
+    timeout = ClientTimeout(total=None, sock_read=60)
+    return ClientSession(connector=connector, timeout=timeout)
+
+
+class _Throttle:
+    def __init__(self, max_requests: int) -> None:
+        self._semaphore = Semaphore(max_requests)
+        self._resume_time = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self._resume_time = max(self._resume_time, monotonic() + seconds)
+
+    async def __aenter__(self) -> None:
+        while True:
+            await sleep(max(0.0, self._resume_time - monotonic()))
+            await self._semaphore.acquire()
+            if monotonic() >= self._resume_time:
+                return
+            # Paused while waiting for a free slot, so give it back.
+            self._semaphore.release()
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._semaphore.release()
+
+
+def _delay_header(response: ClientResponse, name: str) -> Optional[float]:
+    delay = response.headers.get(name)
+    if delay is None:
+        return None
+    try:
+        return float(delay)
+    except ValueError:
+        pass
+    # The delay can also be given as an HTTP date.
+    try:
+        retry_time = parsedate_to_datetime(delay)
+    except (TypeError, ValueError):
+        return None
+    if retry_time.tzinfo is None:
+        retry_time = retry_time.replace(tzinfo=timezone.utc)
+    return (retry_time - datetime.now(timezone.utc)).total_seconds()
+
+
+@asynccontextmanager
+async def _request(
+        session: ClientSession,
+        throttle: _Throttle,
+        url: str,
+        headers: dict[str, str],
+        max_retries: int = 5,
+) -> AsyncIterator[ClientResponse]:
+    for retry in range(max_retries + 1):
+        async with throttle:
+            try:
+                response = await session.get(url, headers=headers)
+            except ClientConnectionError:
+                if retry >= max_retries:
+                    raise
+                delay = 2 ** retry
+            else:
+                async with response:
+                    backoff = _delay_header(response, "Backoff")
+                    if backoff is not None:
+                        # The server is under load and asks us to pause
+                        # all requests for a while.
+                        throttle.pause(backoff)
+                    if (
+                            retry < max_retries and
+                            response.status in {429, 502, 503, 504}
+                    ):
+                        retry_after = _delay_header(response, "Retry-After")
+                        if retry_after is not None:
+                            # The server tells us when to retry,
+                            # so pause all requests until then.
+                            throttle.pause(retry_after)
+                            delay = 0.0
+                        else:
+                            delay = 2 ** retry
+                    else:
+                        response.raise_for_status()
+                        yield response
+                        return
+        await sleep(delay)
+
+
+async def _download_pdf(
+        session: ClientSession,
+        throttle: _Throttle,
         zotero_api_key: str,
         zotero_user_id: str,
-        item: dict,
+        item_id: str,
         item_path: Path,
-) -> None:
-    pdf_url = item["links"]["attachment"]["href"]
-    pdf_id = pdf_url.split("/")[-1]
-
-    response = session.get(
-        url=f"https://api.zotero.org/"
-            f"users/{zotero_user_id}/"
-            f"items/{pdf_id.upper()}/file",
-        headers={
-            "Zotero-API-Version": "3",
-            "Authorization": f"Bearer {zotero_api_key}",
-        },
-    )
-    with item_path.open("wb") as file:
-        file.write(response.content)
+        moving: Future[None],
+        max_retries: int = 5,
+) -> bool:
+    part_path = item_path.with_name(f"{item_path.name}.part")
+    try:
+        for retry in range(max_retries + 1):
+            async with _request(
+                    session,
+                    throttle,
+                    url=f"https://api.zotero.org/"
+                        f"users/{zotero_user_id}/"
+                        f"items/{item_id.upper()}/file",
+                    headers={
+                        "Zotero-API-Version": "3",
+                        "Authorization": f"Bearer {zotero_api_key}",
+                    },
+            ) as response:
+                try:
+                    chunks = response.content.iter_chunked(65536)
+                    async with async_open(part_path, "wb") as file:
+                        async for chunk in chunks:
+                            await file.write(chunk)
+                    break
+                except (ClientConnectionError, ClientPayloadError):
+                    # The connection broke while streaming the file.
+                    if retry >= max_retries:
+                        raise
+            await sleep(2 ** retry)
+    except ClientResponseError as error:
+        if not 400 <= error.status < 500 or error.status == 429:
+            raise
+        # E.g., linked files or files that have not been uploaded yet.
+        tqdm.write(
+            f"Skip PDF {item_id}: {error.status} {error.message}"
+        )
+        return False
+    # Existing files might still be moved away from the target path.
+    await moving
+    part_path.rename(item_path)
+    return True
+
+
+async def _cancel_all(tasks: list[Task]) -> None:
+    for task in tasks:
+        task.cancel()
+    # Wait until the tasks have actually stopped.
+    await gather(*tasks, return_exceptions=True)
+
+
+async def _download_pdfs(
+        session: ClientSession,
+        throttle: _Throttle,
+        zotero_api_key: str,
+        zotero_user_id: str,
+        items: list[tuple[str, Path]],
+        moving: Future[None],
+) -> set[str]:
+    downloads = [
+        create_task(_download_pdf(
+            session,
+            throttle,
+            zotero_api_key,
+            zotero_user_id,
+            item_id,
+            item_path,
+            moving,
+        ))
+        for item_id, item_path in items
+    ]
+    try:
+        for download in tqdm(
+                as_completed(downloads),
+                total=len(downloads),
+                desc="Download PDFs",
+                unit="file",
+        ):
+            await download
+    finally:
+        await _cancel_all(downloads)
+    # Return the items that could not be downloaded.
+    return {
+        item_id
+        for (item_id, _), download in zip(items, downloads)
+        if not download.result()
+    }
 
 
-def _get_items(
-        session: Session,
+async def _get_items_page(
+        session: ClientSession,
+        throttle: _Throttle,
+        url: str,
+        headers: dict[str, str],
+        start: int,
+        limit: int,
+) -> tuple[int, list[dict]]:
+    async with _request(
+            session,
+            throttle,
+            f"{url}?start={start}&limit={limit}",
+            headers=headers,
+    ) as response:
+        total_items = int(response.headers["Total-Results"])
+        items = loads(await response.read())
+    return total_items, items
+
+
+async def _get_items(
+        session: ClientSession,
+        throttle: _Throttle,
         zotero_api_key: str,
         zotero_user_id: str,
         zotero_collection_id: str,
@@ -149,33 +406,47 @@ def _get_items(
         "Zotero-API-Version": "3",
         "Authorization": f"Bearer {zotero_api_key}",
     }
-    total_items_headers = session.get(url, headers=headers).headers
-    total_items = int(total_items_headers["Total-Results"])
+    # Zotero returns at most 100 items per request.
+    limit = 100
+    total_items, first_items = await _get_items_page(
+        session,
+        throttle,
+        url,
+        headers,
+        0,
+        limit,
+    )
 
     progress = tqdm(
         total=total_items,
         desc="Get collection items",
         unit="item",
     )
-    limit = 10
-    all_items = {}
-    for start in range(0, total_items, limit):
-        items_response = session.get(
-            f"{url}?start={start}&limit={limit}",
-            headers=headers,
-        )
-        items_response_json = items_response.json()
-        progress.update(len(items_response_json))
-        all_items.update({
-            _item_id(item): item
-            for item in items_response.json()
-            if _item_has_pdf_attachment(item)
-        })
+    progress.update(len(first_items))
+    pages = [
+        create_task(_get_items_page(
+            session,
+            throttle,
+            url,
+            headers,
+            start,
+            limit,
+        ))
+        for start in range(limit, total_items, limit)
+    ]
+    all_items = _pdf_items(first_items)
+    try:
+        for page in as_completed(pages):
+            _, items = await page
+            progress.update(len(items))
+            all_items.update(_pdf_items(items))
+    finally:
+        await _cancel_all(pages)
 
     return all_items
 
 
-def _sync(
+async def _sync(
         zotero_api_key: str,
         zotero_user_id: str,
         zotero_collection_id: str,
@@ -185,120 +456,123 @@ def _sync(
         export_path: str,
         commit_message: str,
 ) -> None:
-    session = Session()
-    retries = Retry(
-        total=5,
-        backoff_factor=1,
-        status_forcelist=[502, 503, 504],
-    )
-    session.mount("https://", HTTPAdapter(max_retries=retries))
-
+    throttle = _Throttle(5)
     with TemporaryDirectory() as temp_dir:
-        repo_path = Path(temp_dir)
-        repo = Repo.clone_from(
-            git_repository_url,
-            repo_path,
-            depth=1,
-        )
-        with repo.config_writer() as git_config:
-            git_config.set_value("user", "name", git_name)
-            git_config.set_value("user", "email", git_email)
-
-        # Make directories.
-        export_path = repo_path / export_path
-        export_path.mkdir(exist_ok=True)
-        subdir_path = export_path / "other"
-        subdir_path.mkdir(exist_ok=True)
-
-        # Find and read lock file.
-        lock_path = export_path / ".zotero"
-        lock = _read_lock(lock_path, export_path)
-
-        # Find old files.
-        existing_paths: set[Path] = {
-            path
-            for path in export_path.iterdir()
-            if path.is_file() and path.suffix == ".pdf"
-        }
-
-        # Get collection items with PDFs.
-        items = _get_items(
-            session,
-            zotero_api_key,
-            zotero_user_id,
-            zotero_collection_id,
-        )
-
-        # Compute mappings from old to new paths.
-        item_paths: list[tuple[str, Optional[Path], Path]] = [
-            (
-                item_id,
-                lock.get(item_id, None),
-                _item_path(item, export_path)
+        async with _client_session() as session:
+            repo_path = Path(temp_dir)
+
+            # Clone repository and get collection items with PDFs.
+            repo, items = await gather(
+                to_thread(
+                    _clone_repo,
+                    git_repository_url,
+                    repo_path,
+                    export_path,
+                ),
+                _get_items(
+                    session,
+                    throttle,
+                    zotero_api_key,
+                    zotero_user_id,
+                    zotero_collection_id,
+                ),
+                return_exceptions=True,
             )
-            for item_id, item in items.items()
-        ]
-
-        # Move or rename existing files.
-        move_paths = {
-            old_path: new_path
-            for item_id, old_path, new_path in item_paths
-            if old_path is not None
-        }
-        for path in existing_paths:
-            if path in move_paths:
-                # Still in use, rename.
-                path.rename(move_paths[path])
-            else:
-                # No corresponding item, move to subdir.
-                _move_to_subdir(path, subdir_path)
-
-        # Download files.
-        download_items = [
-            (item_id, new_path)
-            for item_id, old_path, new_path in item_paths
-            if old_path is None
-        ]
-        download_items = tqdm(
-            download_items,
-            desc="Download PDFs",
-            unit="file",
-        )
-        for item_id, new_path in download_items:
-            _download_pdf(
+            # Only raise once the clone has stopped writing to the
+            # temporary directory.
+            for result in (repo, items):
+                if isinstance(result, BaseException):
+                    raise result
+            with repo.config_writer() as git_config:
+                git_config.set_value("user", "name", git_name)
+                git_config.set_value("user", "email", git_email)
+                git_config.set_value("lfs", "concurrenttransfers", 8)
+
+            # Make directories.
+            export_path = repo_path / export_path
+            export_path.mkdir(exist_ok=True)
+            subdir_path = export_path / "other"
+            subdir_path.mkdir(exist_ok=True)
+
+            # Find and read lock file.
+            lock_path = export_path / ".zotero"
+            lock = _read_lock(lock_path, export_path)
+
+            # Find old files.
+            with scandir(export_path) as entries:
+                existing_paths: set[Path] = {
+                    Path(entry.path)
+                    for entry in entries
+                    if entry.name.endswith(".pdf") and entry.is_file()
+                }
+
+            # Compute mappings from old to new paths.
+            move_paths: dict[Path, Path] = {}
+            download_items: list[tuple[str, Path]] = []
+            new_lock: dict[str, Path] = {}
+            for item_id, item in items.items():
+                old_path = lock.get(item_id, None)
+                new_path = _item_path(item, export_path)
+                if old_path is not None:
+                    move_paths[old_path] = new_path
+                else:
+                    download_items.append((item_id, new_path))
+                new_lock[item_id] = new_path
+
+            # Move or rename existing files in the background.
+            moving = create_task(to_thread(
+                _move_files,
+                existing_paths,
+                move_paths,
+                subdir_path,
+            ))
+
+            # Download files.
+            downloading = create_task(_download_pdfs(
                 session,
+                throttle,
                 zotero_api_key,
                 zotero_user_id,
-                items[item_id],
-                new_path
-            )
-
-        # Write lock file
-        lock = {item_id: new_path for item_id, _, new_path in item_paths}
-        _write_lock(lock_path, lock)
-
-        if not repo.is_dirty(untracked_files=True):
+                download_items,
+                moving,
+            ))
+
+            try:
+                # Stage moved files while downloads are still in progress,
+                # but skip files that are only partially downloaded.
+                await moving
+                await to_thread(
+                    repo.git.add,
+                    "--all",
+                    "--",
+                    str(export_path),
+                    ":(exclude)*.part",
+                )
+                skipped_item_ids = await downloading
+            finally:
+                # Worker threads cannot be cancelled, so wait for moving.
+                downloading.cancel()
+                await gather(moving, downloading, return_exceptions=True)
+
+        # Write lock file, but retry skipped items on the next run.
+        for item_id in skipped_item_ids:
+            del new_lock[item_id]
+        _write_lock(lock_path, new_lock)
+
+        if not repo.is_dirty(untracked_files=True, path=str(export_path)):
             # Nothing has changed.
             return
         print("Add and commit files to repository.")
-        repo.git.add(".")
+        # Stage all renames, moves, and downloads in a single call.
+        repo.git.add("--all", "--", str(export_path))
         print(repo.git.commit(message=commit_message))
         repo.git.pull()
         print("Push changes.")
+        if _uses_lfs(repo, export_path):
+            # Upload LFS objects first, as the Git push sometimes
+            # gets lost if LFS needs too long.
+            repo.git.lfs("push", "origin", repo.active_branch.name)
         repo.git.push()
-        # Push twice as sometimes if LFS needs to long,
-        # the Git push seems to be forgotten.
-        repo.git.push()
-        status = repo.git.status().strip()
-        if not all(
-                status_line in status
-                for status_line in {
-                    "branch is up to date",
-                    "nothing to commit",
-                    "working tree clean"
-                }
-        ):
-            raise RuntimeError(f"Push unsuccessful: {status}")
 
 
 def main() -> None:
@@ -312,7 +586,7 @@ def main() -> None:
     git_email = config["gitEmail"]
     export_path = config["exportPath"]
     commit_message = config["commitMessage"]
-    _sync(
+    run(_sync(
         zotero_api_key,
         zotero_user_id,
         zotero_collection_id,
@@ -321,7 +595,7 @@ def main() -> None:
         git_email,
         export_path,
         commit_message,
-    )
+    ))
 
 
 if __name__ == "__main__":